@@ -1,11 +1,13 @@
 import logging
+import atexit
 import asyncio
+import inspect
 import re
 import time
 import signal
 import sys
 import threading
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Callable, Awaitable, Union
 from datetime import datetime, timedelta
 from selenium import webdriver
 from selenium.webdriver.common.by import By
@@ -17,33 +19,85 @@ from selenium.webdriver.common.action_chains import ActionChains
 from selenium.common.exceptions import TimeoutException, WebDriverException
 import json
 import os
+import queue
 import socket
-import psutil
 from pathlib import Path
-from logging.handlers import RotatingFileHandler
+from logging.handlers import RotatingFileHandler, QueueHandler, QueueListener
 
 # Konfigurationsdateien
 CONFIG_FILE = "bot_config.json"
 LOG_FILE = "bot.log"
 STATS_FILE = "bot_stats.json"
 PID_FILE = "bot.pid"
-
-
-def setup_logging():
-    """Logging mit automatischer Rotation einrichten"""
+STATS_FLUSH_INTERVAL = 30  # Sekunden
+LOGIN_POLL_FREQUENCY = 1.0  # Sekunden, für längere Login-Wartezeiten
+
+# Alle Captcha-Signaturen als ein kombinierter Selektor, vom Browser in einem Durchlauf geprüft
+CAPTCHA_SELECTOR = "iframe[src*='recaptcha'], iframe[src*='hcaptcha'], div.g-recaptcha"
+CAPTCHA_SCRIPT = f"return !!document.querySelector({json.dumps(CAPTCHA_SELECTOR)});"
+# Für den Tick: ohne geladene Captcha-API (window.grecaptcha/hcaptcha) entfällt die DOM-Suche ganz.
+# Nicht für den Login-Check verwenden – direkt nach get() ist die API oft noch nicht geladen.
+CAPTCHA_TICK_JS = f"!!(window.grecaptcha || window.hcaptcha) && !!document.querySelector({json.dumps(CAPTCHA_SELECTOR)})"
+
+# Locator (CSS statt XPath, wo möglich)
+LOC_TEAMS_EMAIL = (By.ID, "i0116")
+LOC_TEAMS_PW = (By.ID, "i0118")
+LOC_TEAMS_SUBMIT = (By.ID, "idSIButton9")
+LOC_TEAMS_READY = (By.CSS_SELECTOR, "[data-tid='app-bar-chat']")
+LOC_GPT_LOGIN = (By.CSS_SELECTOR, "button[data-testid='login-button']")
+LOC_GPT_EMAIL = (By.ID, "username")
+LOC_GPT_PW = (By.ID, "password")
+LOC_GPT_SUBMIT = (By.CSS_SELECTOR, "button[type='submit']")
+LOC_GPT_READY = (By.CSS_SELECTOR, "textarea[placeholder*='Message']")
+
+
+def setup_logging() -> QueueListener:
+    """Logging mit automatischer Rotation einrichten; geschrieben wird in einem Hintergrund-Thread"""
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(
+        log_queue,
+        RotatingFileHandler(LOG_FILE, maxBytes=10*1024*1024, backupCount=5, encoding='utf-8'),
+        logging.StreamHandler(),
+        respect_handler_level=True
+    )
+    listener.start()
+    # Einmal pro Prozess beim Beenden stoppen, damit die Warteschlange noch geleert wird
+    atexit.register(listener.stop)
     logging.basicConfig(
         level=logging.INFO,
         format='%(asctime)s - %(levelname)s - %(message)s',
-        handlers=[
-            RotatingFileHandler(LOG_FILE, maxBytes=10*1024*1024, backupCount=5, encoding='utf-8'),
-            logging.StreamHandler()
-        ]
+        handlers=[QueueHandler(log_queue)]
     )
+    return listener
 
 setup_logging()
 logger = logging.getLogger(__name__)
 
 
+async def poll_until(pred: Callable[[], Union[bool, Awaitable[bool]]], timeout: Optional[float],
+                     initial: float = 0.5, max_interval: float = 10.0) -> bool:
+    """pred (auch async) mit exponentiellem Backoff prüfen, bis es True liefert (timeout=None: unbegrenzt)"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    delay = initial
+    while True:
+        result = pred()
+        if inspect.isawaitable(result):
+            result = await result
+        if result:
+            return True
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            delay = min(delay, remaining)
+        await asyncio.sleep(delay)
+        delay = min(max_interval, delay * 2)
+
+
+def running_in_container() -> bool:
+    return os.path.exists('/.dockerenv') or os.path.exists('/run/.containerenv')
+
+
 class BotStats:
     def __init__(self):
         self.stats = {
@@ -54,49 +108,75 @@ class BotStats:
             'last_activity': None,
             'uptime': 0
         }
+        self._dirty = False
+        self._last_flush = time.monotonic()
+        self._last_activity: Optional[float] = None
         self.load_stats()
+        self._start_monotonic = time.monotonic() - self.stats.get('uptime', 0)
 
     def load_stats(self):
         try:
             if os.path.exists(STATS_FILE):
-                with open(STATS_FILE, 'r', encoding='utf-8') as f:
-                    self.stats.update(json.load(f))
+                with open(STATS_FILE, 'rb') as f:
+                    self.stats.update(json.loads(f.read()))
         except Exception as e:
             logger.warning(f"Could not load stats: {e}")
 
     def save_stats(self):
+        self._last_flush = time.monotonic()
         try:
-            self.stats['uptime'] = (datetime.now() - datetime.fromisoformat(self.stats['start_time'])).total_seconds()
-            with open(STATS_FILE, 'w', encoding='utf-8') as f:
-                json.dump(self.stats, f, indent=2, ensure_ascii=False)
+            self.stats['uptime'] = time.monotonic() - self._start_monotonic
+            if self._last_activity is not None:
+                self.stats['last_activity'] = datetime.fromtimestamp(self._last_activity).isoformat()
+            data = json.dumps(self.stats, ensure_ascii=False).encode('utf-8')
+            tmp_file = STATS_FILE + '.tmp'
+            with open(tmp_file, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_file, STATS_FILE)
+            self._dirty = False
         except Exception as e:
             logger.warning(f"Could not save stats: {e}")
 
+    def flush(self):
+        if self._dirty:
+            self.save_stats()
+
     def increment(self, key: str):
         self.stats[key] = self.stats.get(key, 0) + 1
-        self.stats['last_activity'] = datetime.now().isoformat()
-        self.save_stats()
+        self._last_activity = time.time()
+        self._dirty = True
+        if time.monotonic() - self._last_flush > STATS_FLUSH_INTERVAL:
+            self.save_stats()
 
 
 class NetworkChecker:
+    CACHE_TTL = 30  # Sekunden
+    # Minimale DNS-Anfrage (NS-Record der Root-Zone), beantwortet jeder Resolver
+    DNS_QUERY = b'\x00\x01\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x02\x00\x01'
+    _last_success: Optional[float] = None
+
     @staticmethod
     def is_connected() -> bool:
-        try:
-            socket.create_connection(("8.8.8.8", 53), timeout=5)
+        last = NetworkChecker._last_success
+        if last is not None and time.monotonic() - last < NetworkChecker.CACHE_TTL:
             return True
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+                sock.settimeout(1.0)
+                sock.sendto(NetworkChecker.DNS_QUERY, ("1.1.1.1", 53))
+                sock.recv(512)
         except OSError:
             return False
+        NetworkChecker._last_success = time.monotonic()
+        return True
 
     @staticmethod
-    def wait_for_network(timeout: int = 300) -> bool:
+    async def wait_for_network(timeout: int = 300) -> bool:
         logger.info("Waiting for network connection...")
-        start_time = time.time()
-
-        while time.time() - start_time < timeout:
-            if NetworkChecker.is_connected():
-                logger.info("Network connection established")
-                return True
-            time.sleep(5)
+        # Die Probe blockiert bis zu 1s, daher im Thread statt auf dem Event-Loop
+        if await poll_until(lambda: asyncio.to_thread(NetworkChecker.is_connected), timeout):
+            logger.info("Network connection established")
+            return True
 
         logger.error("Network connection timeout")
         return False
@@ -137,6 +217,21 @@ class ProcessManager:
                 with open(PID_FILE, 'r') as f:
                     pid = int(f.read().strip())
 
+                if sys.platform.startswith('linux'):
+                    # Billiger Existenztest per Signal 0, cmdline nur bei lebendem Prozess lesen
+                    try:
+                        os.kill(pid, 0)
+                    except ProcessLookupError:
+                        return False
+                    except PermissionError:
+                        pass
+                    try:
+                        with open(f"/proc/{pid}/cmdline", 'rb') as f:
+                            return b'teams_chatgpt_bot' in f.read()
+                    except FileNotFoundError:
+                        return False
+
+                import psutil  # nur hier benötigt, daher nicht beim Start importiert
                 try:
                     process = psutil.Process(pid)
                     if 'teams_chatgpt_bot' in ' '.join(process.cmdline()):
@@ -157,57 +252,67 @@ class TeamsBot:
         self.is_running = False
         self.processed_messages = set()
         self.stats = BotStats()
+        self._stats_task: Optional[asyncio.Task] = None
         self.process_manager = ProcessManager()
         self.last_health_check = datetime.now()
         self.health_check_interval = timedelta(minutes=5)
         self.max_retries = config.get('max_retries', 3)
         self.retry_delay = config.get('retry_delay', 30)
+        # Alle DOM-Abfragen eines Ticks in einem einzigen execute_script-Aufruf
+        self._tick_js = """
+            return (function() {
+                return {
+                    captcha_present: %s,
+                    logged_in: !!document.querySelector(%s)
+                };
+            })();
+        """ % (CAPTCHA_TICK_JS, json.dumps(LOC_TEAMS_READY[1]))
 
     def detect_captcha(self, driver) -> bool:
         try:
-            if driver.find_elements(By.CSS_SELECTOR, "iframe[src*='recaptcha']") or \               driver.find_elements(By.CSS_SELECTOR, "iframe[src*='hcaptcha']") or \               driver.find_elements(By.CSS_SELECTOR, "div.g-recaptcha"):
+            if driver.execute_script(CAPTCHA_SCRIPT):
                 logger.warning("⚠️ Captcha detected – please solve it manually in the browser!")
                 return True
-        except Exception:
+        except WebDriverException:
             pass
         return False
 
-    async def login_to_teams(self) -> bool:
-        try:
-            logger.info("Starte Teams-Login...")
-            self.teams_driver = self.setup_driver()
-            self.teams_driver.get("https://teams.microsoft.com")
+    async def wait_for_captcha(self, driver):
+        """Warten, bis kein Captcha mehr angezeigt wird; die WebDriver-Abfragen laufen im Thread"""
+        async def captcha_cleared() -> bool:
+            return not await asyncio.to_thread(self.detect_captcha, driver)
 
-            if self.detect_captcha(self.teams_driver):
-                while self.detect_captcha(self.teams_driver):
-                    time.sleep(5)
+        await poll_until(captcha_cleared, None)
 
-            email_input = WebDriverWait(self.teams_driver, 15).until(
-                EC.presence_of_element_located((By.ID, "i0116"))
+    def wait_for_page(self, driver, *locators):
+        """Nach get() (eager) warten, bis ein Captcha oder eines der erwarteten Elemente im DOM steht"""
+        try:
+            WebDriverWait(driver, 15, poll_frequency=LOGIN_POLL_FREQUENCY).until(
+                EC.any_of(
+                    EC.presence_of_element_located((By.CSS_SELECTOR, CAPTCHA_SELECTOR)),
+                    *(EC.presence_of_element_located(locator) for locator in locators)
+                )
             )
-            email_input.clear()
-            email_input.send_keys(self.config['teams_email'])
+        except TimeoutException:
+            pass
 
-            self.teams_driver.find_element(By.ID, "idSIButton9").click()
+    def read_page_state(self, driver) -> Dict[str, Any]:
+        try:
+            return driver.execute_script(self._tick_js) or {}
+        except WebDriverException as e:
+            logger.warning(f"Could not read page state: {e}")
+            return {}
 
-            password_input = WebDriverWait(self.teams_driver, 15).until(
-                EC.presence_of_element_located((By.ID, "i0118"))
-            )
-            password_input.clear()
-            password_input.send_keys(self.config['teams_password'])
-            self.teams_driver.find_element(By.ID, "idSIButton9").click()
+    async def login_to_teams(self) -> bool:
+        try:
+            logger.info("Starte Teams-Login...")
+            self.teams_driver = await asyncio.to_thread(self.setup_driver, "teams")
+            await asyncio.to_thread(self.teams_driver.get, "https://teams.microsoft.com")
+            await asyncio.to_thread(self.wait_for_page, self.teams_driver, LOC_TEAMS_READY, LOC_TEAMS_EMAIL)
 
-            try:
-                stay_signed_in = WebDriverWait(self.teams_driver, 5).until(
-                    EC.element_to_be_clickable((By.ID, "idSIButton9"))
-                )
-                stay_signed_in.click()
-            except TimeoutException:
-                pass
+            await self.wait_for_captcha(self.teams_driver)
 
-            WebDriverWait(self.teams_driver, 30).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, "[data-tid='app-bar-chat']"))
-            )
+            await asyncio.to_thread(self._login_to_teams_sync)
             logger.info("Successfully logged into Teams")
             return True
 
@@ -215,42 +320,53 @@ class TeamsBot:
             logger.error(f"Teams login error: {e}")
             return False
 
-    async def login_to_chatgpt(self) -> bool:
-        try:
-            logger.info("Starte ChatGPT-Login...")
-            self.chatgpt_driver = self.setup_driver()
-            self.chatgpt_driver.get("https://chat.openai.com")
+    def _login_to_teams_sync(self):
+        # Mit gespeichertem Profil ist die Sitzung oft noch gültig: auf App-Leiste oder Login-Formular warten
+        first = WebDriverWait(self.teams_driver, 30, poll_frequency=LOGIN_POLL_FREQUENCY).until(
+            EC.any_of(
+                EC.presence_of_element_located(LOC_TEAMS_READY),
+                EC.presence_of_element_located(LOC_TEAMS_EMAIL)
+            )
+        )
+        if first.get_attribute("id") != LOC_TEAMS_EMAIL[1]:
+            logger.info("Teams session restored from profile")
+            return
 
-            if self.detect_captcha(self.chatgpt_driver):
-                while self.detect_captcha(self.chatgpt_driver):
-                    time.sleep(5)
+        email_input = first
+        email_input.clear()
+        email_input.send_keys(self.config['teams_email'])
 
-            login_button = WebDriverWait(self.chatgpt_driver, 10).until(
-                EC.element_to_be_clickable((By.XPATH, "//button[contains(text(), 'Log in')]"))
-            )
-            login_button.click()
+        self.teams_driver.find_element(*LOC_TEAMS_SUBMIT).click()
+
+        password_input = WebDriverWait(self.teams_driver, 15, poll_frequency=LOGIN_POLL_FREQUENCY).until(
+            EC.presence_of_element_located(LOC_TEAMS_PW)
+        )
+        password_input.clear()
+        password_input.send_keys(self.config['teams_password'])
+        self.teams_driver.find_element(*LOC_TEAMS_SUBMIT).click()
 
-            email_input = WebDriverWait(self.chatgpt_driver, 15).until(
-                EC.presence_of_element_located((By.ID, "username"))
+        try:
+            stay_signed_in = WebDriverWait(self.teams_driver, 5).until(
+                EC.element_to_be_clickable(LOC_TEAMS_SUBMIT)
             )
-            email_input.clear()
-            email_input.send_keys(self.config['chatgpt_email'])
+            stay_signed_in.click()
+        except TimeoutException:
+            pass
 
-            continue_button = self.chatgpt_driver.find_element(By.XPATH, "//button[@type='submit']")
-            continue_button.click()
+        WebDriverWait(self.teams_driver, 30, poll_frequency=LOGIN_POLL_FREQUENCY).until(
+            EC.presence_of_element_located(LOC_TEAMS_READY)
+        )
 
-            password_input = WebDriverWait(self.chatgpt_driver, 15).until(
-                EC.presence_of_element_located((By.ID, "password"))
-            )
-            password_input.clear()
-            password_input.send_keys(self.config['chatgpt_password'])
+    async def login_to_chatgpt(self) -> bool:
+        try:
+            logger.info("Starte ChatGPT-Login...")
+            self.chatgpt_driver = await asyncio.to_thread(self.setup_driver, "chatgpt")
+            await asyncio.to_thread(self.chatgpt_driver.get, "https://chat.openai.com")
+            await asyncio.to_thread(self.wait_for_page, self.chatgpt_driver, LOC_GPT_LOGIN, LOC_GPT_READY)
 
-            continue_button = self.chatgpt_driver.find_element(By.XPATH, "//button[@type='submit']")
-            continue_button.click()
+            await self.wait_for_captcha(self.chatgpt_driver)
 
-            WebDriverWait(self.chatgpt_driver, 30).until(
-                EC.presence_of_element_located((By.CSS_SELECTOR, "textarea[placeholder*='Message']"))
-            )
+            await asyncio.to_thread(self._login_to_chatgpt_sync)
             logger.info("Successfully logged into ChatGPT")
             return True
 
@@ -258,31 +374,105 @@ class TeamsBot:
             logger.error(f"ChatGPT login error: {e}")
             return False
 
-    def setup_driver(self) -> webdriver.Chrome:
+    def _login_to_chatgpt_sync(self):
+        # Das Eingabefeld gibt es auch abgemeldet; entscheidend ist daher allein der Login-Button
+        WebDriverWait(self.chatgpt_driver, 30, poll_frequency=LOGIN_POLL_FREQUENCY).until(
+            EC.any_of(
+                EC.presence_of_element_located(LOC_GPT_LOGIN),
+                EC.presence_of_element_located(LOC_GPT_READY)
+            )
+        )
+        if not self.chatgpt_driver.find_elements(*LOC_GPT_LOGIN):
+            logger.info("ChatGPT session restored from profile")
+            return
+
+        login_button = WebDriverWait(self.chatgpt_driver, 10, poll_frequency=LOGIN_POLL_FREQUENCY).until(
+            EC.element_to_be_clickable(LOC_GPT_LOGIN)
+        )
+        login_button.click()
+
+        email_input = WebDriverWait(self.chatgpt_driver, 15, poll_frequency=LOGIN_POLL_FREQUENCY).until(
+            EC.presence_of_element_located(LOC_GPT_EMAIL)
+        )
+        email_input.clear()
+        email_input.send_keys(self.config['chatgpt_email'])
+
+        continue_button = self.chatgpt_driver.find_element(*LOC_GPT_SUBMIT)
+        continue_button.click()
+
+        password_input = WebDriverWait(self.chatgpt_driver, 15, poll_frequency=LOGIN_POLL_FREQUENCY).until(
+            EC.presence_of_element_located(LOC_GPT_PW)
+        )
+        password_input.clear()
+        password_input.send_keys(self.config['chatgpt_password'])
+
+        continue_button = self.chatgpt_driver.find_element(*LOC_GPT_SUBMIT)
+        continue_button.click()
+
+        WebDriverWait(self.chatgpt_driver, 30, poll_frequency=LOGIN_POLL_FREQUENCY).until(
+            EC.presence_of_element_located(LOC_GPT_READY)
+        )
+
+    def setup_driver(self, profile_name: Optional[str] = None) -> webdriver.Chrome:
         chrome_options = Options()
-        if self.config.get('headless', False):
-            chrome_options.add_argument("--headless")
-            chrome_options.add_argument("--no-sandbox")
-            chrome_options.add_argument("--disable-dev-shm-usage")
+        profile_dir = self.config.get('profile_dir')
+        if profile_dir and profile_name:
+            # Eigenes Profil pro Browser, damit Cookies einen Neustart überleben
+            user_data_dir = os.path.abspath(os.path.join(profile_dir, profile_name))
+            chrome_options.add_argument(f"--user-data-dir={user_data_dir}")
+            chrome_options.add_argument("--profile-directory=Default")
+
+        headless = self.config.get('headless', False)
+        if headless:
+            chrome_options.add_argument("--headless=new")
             chrome_options.add_argument("--disable-gpu")
+        if headless or running_in_container():
+            chrome_options.add_argument("--no-sandbox")
+
+        # /dev/shm ist auf kleinen Hosts und in Containern oft zu knapp
+        chrome_options.add_argument("--disable-dev-shm-usage")
+        chrome_options.add_argument("--disable-features=Translate,BackForwardCache")
+        chrome_options.add_argument("--memory-pressure-off")
+        chrome_options.add_argument("--renderer-process-limit=2")
 
         chrome_options.add_argument("--disable-blink-features=AutomationControlled")
         chrome_options.add_experimental_option("excludeSwitches", ["enable-automation"])
         chrome_options.add_experimental_option('useAutomationExtension', False)
 
+        # Bilder und Benachrichtigungen werden für den Textbetrieb nicht gebraucht.
+        # Stylesheets bleiben aktiv: element_to_be_clickable prüft die Sichtbarkeit über das berechnete Layout.
+        prefs = {
+            "profile.managed_default_content_settings.images": 2,
+            "profile.default_content_setting_values.notifications": 2
+        }
+        chrome_options.add_experimental_option("prefs", prefs)
+        chrome_options.add_argument("--blink-settings=imagesEnabled=false")
+        chrome_options.add_argument("--disable-extensions")
+        chrome_options.add_argument("--disable-background-networking")
+        chrome_options.add_argument("--disable-sync")
+        # get() kehrt nach DOMContentLoaded zurück, statt auf alle Ressourcen zu warten;
+        # danach wartet wait_for_page explizit auf Captcha oder Login-Elemente
+        chrome_options.page_load_strategy = "eager"
+
         driver = webdriver.Chrome(options=chrome_options)
         driver.set_page_load_timeout(30)
-        driver.implicitly_wait(10)
+        # Nur explizite WebDriverWaits – implizite Wartezeit würde jeden Fehlgriff um 10s verzögern
+        driver.implicitly_wait(0)
         return driver
 
+    async def flush_stats_periodically(self):
+        while True:
+            await asyncio.sleep(STATS_FLUSH_INTERVAL)
+            self.stats.flush()
+
     async def start(self):
         logger.info("Starting Teams-ChatGPT Bot...")
-        teams_login = await self.login_to_teams()
+        self._stats_task = asyncio.create_task(self.flush_stats_periodically())
+        teams_login, chatgpt_login = await asyncio.gather(self.login_to_teams(), self.login_to_chatgpt())
         if not teams_login:
             logger.error("Failed to login to Teams")
             return
 
-        chatgpt_login = await self.login_to_chatgpt()
         if not chatgpt_login:
             logger.error("Failed to login to ChatGPT")
             return
@@ -290,11 +480,19 @@ class TeamsBot:
         logger.info("Bot successfully started and ready!")
         self.is_running = True
         while self.is_running:
+            state = await asyncio.to_thread(self.read_page_state, self.teams_driver)
+            if state.get('captcha_present'):
+                await self.wait_for_captcha(self.teams_driver)
+            elif state and not state.get('logged_in'):
+                logger.warning("Teams session appears to be logged out")
             await asyncio.sleep(self.config.get('check_interval', 10))
 
     async def stop(self):
         logger.info("Stopping bot...")
         self.is_running = False
+        if self._stats_task:
+            self._stats_task.cancel()
+        self.stats.flush()
         if self.teams_driver:
             self.teams_driver.quit()
         if self.chatgpt_driver:
@@ -304,8 +502,8 @@ class TeamsBot:
 
 def load_config() -> Dict[str, Any]:
     if os.path.exists(CONFIG_FILE):
-        with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+        with open(CONFIG_FILE, 'rb') as f:
+            return json.loads(f.read())
     else:
         config = {
             "teams_email": "",
@@ -316,7 +514,8 @@ def load_config() -> Dict[str, Any]:
             "check_interval": 10,
             "headless": False,
             "max_retries": 3,
-            "retry_delay": 30
+            "retry_delay": 30,
+            "profile_dir": "chrome_profiles"
         }
         with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
             json.dump(config, f, indent=2, ensure_ascii=False)